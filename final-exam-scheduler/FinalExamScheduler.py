@@ -1,112 +1,842 @@
 # This program takes enrollment data and creates an exam schedule with no time conflicts using sets and graph coloring
 
-enrollment = {}
-timeslots = {0:[]}
-currentstudentid = 0
-lasttimeslotid = 0
-courses = set()
+import csv
+import os
+import json
+import hashlib
+from itertools import islice
+import numpy as np
+import scipy.sparse
+import scipy.sparse.csgraph
+from multiprocessing import Pool
+from time import perf_counter
 
 class coursenode(): # Each course is represented by a node
-    def __init__(self,name):
-        global courses
+    def __init__(self,name,index):
         self.name = name
+        self.index = index # Position of the course in the catalog and in the sparse matrices
         self.connections = set() # Edges are created between 2 nodes if any student is taking both courses
-        courses=courses.union([self])
-
-def addstudent(*args):
-    global currentstudentid
-    courselist =set()
-    for arg in args:
-        course = arg
-        if course not in [x.name for x in courses]: # New course is created if not in previous student's schedules
-            course = coursenode(course)
+        self.students = set() # Ids of the students taking the course
+        self.slot = None # Time slot of the course once scheduled
+
+class examscheduler(): # All enrollment data and the schedule, so separate schedules (or processes) never share state
+    def __init__(self):
+        self.enrollment = {}
+        self.timeslots = {0:[]}
+        self.currentstudentid = 0
+        self.lasttimeslotid = 0
+        self.courses = set()
+        self.catalog = {} # Course nodes by name
+        self.conflicts = None # Course by course matrix of the number of students shared by each pair of courses
+        self.studentnames = {} # Internal student ids by the ids used in loaded files
+
+    def addcourse(self, name): # Creates a course node at the next catalog index
+        course = coursenode(name, len(self.catalog))
+        self.courses.add(course)
+        self.catalog[name] = course
+        return course
+
+    def addstudent(self, *args, connect=True): # Without connecting, edges are left to buildgraph()
+        courselist =set()
+        for arg in args:
+            course = self.catalog.get(arg)
+            if course is None: # New course is created if not in previous student's schedules
+                course = self.addcourse(arg)
+            courselist.add(course) # Set of all courses a student is taking
+            course.students.add(self.currentstudentid)
+        self.enrollment.update({self.currentstudentid:courselist})
+        if connect:
+            for x in courselist: # Edges are created between all courses a student is enrolled in (if not already connected)
+                x.connections.update(courselist)
+                x.connections.discard(x)
+        self.currentstudentid += 1
+
+    def addenrollment(self, matrix, connect=True): # Adds a student for each row of a student by course array of course names
+        names, inverse = np.unique(matrix, return_inverse=True)
+        lookup = np.array([(self.catalog.get(x) or self.addcourse(x)).index for x in names.tolist()], dtype=np.int64)
+        columns = lookup[inverse.reshape(-1)].reshape(np.shape(matrix))
+        self.addrows(np.arange(len(columns) + 1) * columns.shape[1], columns.reshape(-1))
+        if connect: # All edges come from the sparse builder instead of one student at a time
+            self.buildgraph()
+
+    def addrows(self, indptr, columns): # Adds a student for each row of compressed sparse rows of catalog indices
+        nodes = list(self.catalog.values())
+        counts = np.diff(indptr)
+        ids = np.arange(self.currentstudentid, self.currentstudentid + len(counts))
+        columnlist = columns.tolist()
+        bounds = indptr.tolist()
+        self.enrollment.update(zip(ids.tolist(), (set(map(nodes.__getitem__, columnlist[a:b])) for a, b in zip(bounds[:-1], bounds[1:]))))
+        # Students of each course come from grouping the entries by course
+        order = np.argsort(columns, kind='stable')
+        taking = np.repeat(ids, counts)[order]
+        bounds = np.searchsorted(columns[order], np.arange(len(nodes) + 1))
+        for j in np.flatnonzero(np.diff(bounds)).tolist():
+            nodes[j].students.update(taking[bounds[j]:bounds[j+1]].tolist())
+        self.currentstudentid += len(counts)
+
+    def incidence(self): # Sparse student by course matrix with a 1 for each enrollment
+        rows = np.repeat(np.fromiter(self.enrollment.keys(), dtype=np.int64, count=len(self.enrollment)),
+                         [len(x) for x in self.enrollment.values()])
+        columns = np.fromiter((x.index for y in self.enrollment.values() for x in y), dtype=np.int64, count=len(rows))
+        return scipy.sparse.csr_matrix((np.ones(len(rows), dtype=np.int32), (rows, columns)),
+                                       shape=(self.currentstudentid, len(self.catalog)))
+
+    def buildgraph(self): # Builds all edges at once from the product of the incidence matrix with itself
+        a = self.incidence()
+        self.conflicts = (a.T @ a).tocsr() # Entry (i,j) is the number of students taking both course i and course j
+        self.linkgraph()
+        return self.conflicts
+
+    def linkgraph(self): # Sets the connections of every course from the nonzero entries of the conflict matrix
+        self.conflicts.setdiag(0)
+        self.conflicts.eliminate_zeros()
+        nodes = list(self.catalog.values())
+        for x in nodes:
+            x.connections = set(nodes[j] for j in self.conflicts.indices[self.conflicts.indptr[x.index]:self.conflicts.indptr[x.index+1]])
+
+    def savegraph(self, filename, key='', malformed=()): # Saves the course index, enrollments and conflict graph as arrays in an .npz file
+        if self.conflicts is None or self.conflicts.shape[0] != len(self.catalog):
+            self.buildgraph()
+        a = self.incidence()
+        names = np.asarray(list(self.catalog))
+        if names.dtype == object: # Mixed names are stored as text so the file can be read without pickle
+            names = names.astype(str)
+        students = sorted(self.studentnames, key=self.studentnames.get) # Ids from loaded files, by internal id
+        np.savez_compressed(filename, key=np.array(key), names=names, students=np.array(students, dtype=str),
+                            conflictptr=self.conflicts.indptr, conflictindices=self.conflicts.indices, conflictweights=self.conflicts.data,
+                            enrollmentptr=a.indptr, enrollmentindices=a.indices, malformed=np.array(json.dumps(malformed)))
+
+    def loadgraph(self, filename): # Loads a file from savegraph() into an empty scheduler and returns the malformed rows stored with it
+        if self.catalog:
+            raise ValueError('A graph can only be loaded into an empty scheduler')
+        with np.load(filename) as data:
+            for name in data['names'].tolist():
+                self.addcourse(name)
+            self.addrows(data['enrollmentptr'], data['enrollmentindices'])
+            n = len(self.catalog)
+            self.conflicts = scipy.sparse.csr_matrix((data['conflictweights'], data['conflictindices'], data['conflictptr']), shape=(n, n))
+            self.studentnames = {x: i for i, x in enumerate(data['students'].tolist())}
+            malformed = [tuple(x) for x in json.loads(str(data['malformed']))]
+        self.linkgraph()
+        return malformed
+
+    def loadcsv(self, filename, chunksize=100000, header=True, cache=None): # Streams (student_id, course) rows and returns the malformed ones
+        # With a cache directory, the graph of a file is saved there the first time and loaded from there afterwards
+        if cache is not None and not self.catalog: # The key only covers the file, so the scheduler has to start empty
+            path = os.path.join(cache, filekey(filename, header) + '.npz')
+            if os.path.exists(path):
+                return self.loadgraph(path)
+            malformed = self.loadcsv(filename, chunksize, header)
+            os.makedirs(cache, exist_ok=True)
+            self.savegraph(path, filekey(filename, header), malformed)
+            return malformed
+        if self.conflicts is None or self.conflicts.shape[0] != len(self.catalog):
+            self.buildgraph() # Earlier students have to be in the matrix before it is updated
+        malformed = [] # (line number, row) for every skipped row
+        with open(filename, newline='') as file:
+            reader = csv.reader(file)
+            if header:
+                next(reader, None)
+            numbered = ((reader.line_num, row) for row in reader)
+            while True:
+                chunk = list(islice(numbered, chunksize)) # Only one chunk of rows is held in memory at a time
+                if not chunk:
+                    break
+                touched = {} # Row in this chunk's matrices for each student with new courses
+                newrows = []
+                newcolumns = []
+                for line, row in chunk:
+                    row = [x.strip() for x in row]
+                    if row == [] or row == ['']: # Blank lines are ignored
+                        continue
+                    if len(row) != 2 or row[0] == '' or row[1] == '':
+                        malformed.append((line, row))
+                        continue
+                    studentid = self.studentnames.get(row[0])
+                    if studentid is None:
+                        studentid = self.currentstudentid
+                        self.studentnames[row[0]] = studentid
+                        self.enrollment[studentid] = set()
+                        self.currentstudentid += 1
+                    course = self.catalog.get(row[1]) or self.addcourse(row[1])
+                    if course in self.enrollment[studentid]: # Repeated rows do not add another student to an edge
+                        continue
+                    self.enrollment[studentid].add(course)
+                    course.students.add(studentid)
+                    newrows.append(touched.setdefault(studentid, len(touched)))
+                    newcolumns.append(course.index)
+                self.addconflicts(touched, newrows, newcolumns)
+        self.linkgraph()
+        if malformed:
+            print(len(malformed), 'malformed rows skipped, first on line', malformed[0][0])
+        return malformed
+
+    def addconflicts(self, touched, newrows, newcolumns): # Adds the edges of new enrollments of the touched students to the conflict matrix
+        # With B the new enrollments and A all enrollments of the touched students, the product of the
+        # incidence matrix with itself grows by B^T A + A^T B - B^T B
+        n = len(self.catalog)
+        b = scipy.sparse.csr_matrix((np.ones(len(newrows), dtype=np.int32), (newrows, newcolumns)), shape=(len(touched), n))
+        rows = np.repeat(np.arange(len(touched)), [len(self.enrollment[x]) for x in touched])
+        columns = np.fromiter((z.index for x in touched for z in self.enrollment[x]), dtype=np.int64, count=len(rows))
+        a = scipy.sparse.csr_matrix((np.ones(len(rows), dtype=np.int32), (rows, columns)), shape=(len(touched), n))
+        crossed = b.T @ a
+        self.conflicts.resize((n, n))
+        self.conflicts = (self.conflicts + crossed + crossed.T - b.T @ b).tocsr()
+
+    def adjacency(self): # Connections of every course as arrays of catalog indices (compressed sparse rows)
+        nodes = list(self.catalog.values())
+        degrees = np.fromiter((len(x.connections) for x in nodes), dtype=np.int64, count=len(nodes))
+        if self.conflicts is not None and self.conflicts.shape[0] == len(nodes) and self.conflicts.nnz == degrees.sum():
+            return nodes, self.conflicts.indptr, self.conflicts.indices # The graph from buildgraph() has not changed since
+        indptr = np.concatenate([[0], np.cumsum(degrees)])
+        indices = np.fromiter((z.index for x in nodes for z in x.connections), dtype=np.int64, count=indptr[-1])
+        return nodes, indptr, indices
+
+    def components(self): # Lists of courses with no connections between different lists, largest first
+        nodes, indptr, indices = self.adjacency()
+        graph = scipy.sparse.csr_matrix((np.ones(len(indices), dtype=np.int8), indices, indptr), shape=(len(nodes), len(nodes)))
+        count, labels = scipy.sparse.csgraph.connected_components(graph, directed=False)
+        order = np.argsort(labels, kind='stable')
+        parts = np.split(order, np.cumsum(np.bincount(labels, minlength=count))[:-1])
+        parts.sort(key=len, reverse=True)
+        return [[nodes[i] for i in part.tolist()] for part in parts]
+
+    def colorparts(self, parts, method='firstfit', processes=1, parallelsize=1000):
+        # Colors each part (a whole component, or several) on its own and merges the results into the time slots
+        # Parts share no connections, so each part can reuse the same time slots starting from 0
+        nodes, indptr, indices = self.adjacency()
+        graph = scipy.sparse.csr_matrix((np.ones(len(indices), dtype=np.int8), indices, indptr), shape=(len(nodes), len(nodes)))
+        small = [x for part in parts if len(part) < parallelsize for x in part] # Small parts are colored together in one pass
+        parts = [part for part in parts if len(part) >= parallelsize] + ([small] if small else [])
+        jobs = []
+        for part in parts:
+            index = np.array([x.index for x in part], dtype=np.int64)
+            subgraph = graph[index][:, index]
+            jobs.append((subgraph.indptr, subgraph.indices, method))
+        if processes > 1 and len(jobs) > 1:
+            with Pool(processes) as pool:
+                coloring = pool.map(colorsubgraph, jobs)
+        else:
+            coloring = [colorsubgraph(x) for x in jobs]
+        recolored = set(x for part in parts for x in part)
+        for y in self.timeslots: # Courses of the parts leave their old time slots
+            self.timeslots[y] = [x for x in self.timeslots[y] if x not in recolored]
+        for y in range(self.lasttimeslotid + 1, max([int(x.max(initial=0)) for x in coloring] + [0]) + 1):
+            self.timeslots.update({y:[]}) # Time slots used by any part
+        self.lasttimeslotid = len(self.timeslots) - 1
+        for part, slots in zip(parts, coloring):
+            for x, y in zip(part, slots.tolist()):
+                x.slot = None
+                self.place(x, y)
+        self.trim()
+
+    def schedule(self, display=True, method='firstfit', components=False, processes=1):
+        # Method is 'firstfit' or 'dsatur', and with components each connected component is colored on its own
+        if components:
+            # Only components with an unscheduled course are colored again
+            self.colorparts([x for x in self.components() if any(z.slot is None for z in x)], method, processes)
         else:
-            course = [x for x in courses if course == x.name][0]
-        courselist = courselist.union([course]) # Set of all courses a student is taking
-    enrollment.update({currentstudentid:courselist})
-    for x in courselist: # Edges are created between all courses a student is enrolled in (if not already connected)
-        x.connections = x.connections.union(courselist.difference([x]))
-    currentstudentid += 1
-
-def schedule(display=True):
-    global lasttimeslotid
-    for x in courses:
-        for y in range(0,lasttimeslotid+1): # Assign if slot is empty or course is not connected to courses in time slot
-            if timeslots[y] == [] \
-                or x.connections.intersection(timeslots[y])==set():
-                timeslots[y].append(x)
+            nodes, indptr, indices = self.adjacency()
+            slotof = np.full(len(nodes), -1) # Courses already in a time slot are kept there
+            for y in self.timeslots:
+                for x in self.timeslots[y]:
+                    slotof[x.index] = y
+            coloring = dsatur if method == 'dsatur' else firstfit
+            for i in coloring(indptr, indices, slotof, self.lasttimeslotid + 1): # New time slots are created in order
+                self.place(nodes[i], int(slotof[i]))
+        if display == True: # Print schedule
+            for i in self.timeslots:
+                print('Time slot ' + str(i))
+                for j in self.timeslots[i]:
+                    print(j.name)
+            stats = self.validate()
+            print('Conflicts:', stats['conflicts'], ' Back-to-back exams:', stats['backtoback'], ' Most exams in a day:', stats['maxperday'])
+        return len(self.timeslots)
+
+    def improve(self, seconds=10, objective='timeslots', slotsperday=3, seed=None):
+        # Local search on a finished schedule for up to the given number of seconds, keeping the best valid schedule found
+        # The objective 'timeslots' removes time slots, and 'backtoback' reduces back-to-back exams with the same time slots
+        if objective not in ('timeslots', 'backtoback'):
+            raise ValueError('Invalid objective ' + str(objective))
+        deadline = perf_counter() + seconds
+        if not self.catalog:
+            return len(self.timeslots)
+        if any(x.slot is None for x in self.catalog.values()):
+            self.schedule(display=False)
+        nodes, indptr, indices = self.adjacency()
+        if self.conflicts is None or indices is not self.conflicts.indices: # The number of shared students is needed as edge weights
+            self.buildgraph()
+        slotof = np.array([x.slot for x in nodes], dtype=np.int64)
+        rng = np.random.default_rng(seed)
+        if objective == 'backtoback':
+            best = spreadexams(self.conflicts.indptr, self.conflicts.indices, self.conflicts.data, slotof, slotsperday, deadline, rng)
+        elif objective == 'timeslots':
+            best = removeslots(self.conflicts.indptr, self.conflicts.indices, self.conflicts.data, slotof, deadline, rng)
+            best = np.unique(best, return_inverse=True)[1].reshape(-1) # Time slots emptied by the search are closed up
+        self.timeslots = {y: [] for y in range(int(best.max()) + 1)}
+        self.lasttimeslotid = len(self.timeslots) - 1
+        for x, y in zip(nodes, best.tolist()):
+            x.slot = y
+            self.timeslots[y].append(x)
+        return len(self.timeslots)
+
+    def validate(self, slotsperday=3): # Checks the schedule against every student's enrollment and measures its quality
+        a = self.incidence()
+        n = len(self.catalog)
+        count = len(self.timeslots)
+        slotof = np.fromiter((-1 if x.slot is None else x.slot for x in self.catalog.values()), dtype=np.int64, count=n)
+        scheduled = np.flatnonzero(slotof >= 0)
+        ones = np.ones(len(scheduled), dtype=np.int32)
+        # Student by time slot and student by day matrices of the number of exams, from course to slot (or day) matrices
+        perslot = (a @ scipy.sparse.csr_matrix((ones, (scheduled, slotof[scheduled])), shape=(n, count))).tocsr()
+        perday = (a @ scipy.sparse.csr_matrix((ones, (scheduled, slotof[scheduled] // slotsperday)), shape=(n, -(-count // slotsperday)))).tocsr()
+        perslot.sort_indices()
+        exams = perslot.data
+        students = np.repeat(np.arange(perslot.shape[0]), np.diff(perslot.indptr))
+        clashing = exams > 1
+        # Exams in consecutive time slots of the same day, found from neighbouring entries of each student's row
+        slots = perslot.indices
+        adjacent = (students[1:] == students[:-1]) & (slots[1:] == slots[:-1] + 1) & (slots[1:] // slotsperday == slots[:-1] // slotsperday)
+        mostperday = perday.max(axis=1).toarray().ravel() if perday.shape[1] > 0 else np.zeros(perday.shape[0], dtype=np.int64)
+        conflicts = int((exams * (exams - 1) // 2).sum()) # Pairs of a student's exams in the same time slot
+        unscheduled = n - len(scheduled)
+        return {'valid': conflicts == 0 and unscheduled == 0,
+                'timeslots': count,
+                'days': -(-count // slotsperday),
+                'unscheduled': unscheduled,
+                'conflicts': conflicts,
+                'conflictstudents': len(np.unique(students[clashing])),
+                'backtoback': int((exams[:-1] * exams[1:])[adjacent].sum()), # Pairs of exams in back-to-back time slots
+                'backtobackstudents': len(np.unique(students[:-1][adjacent])),
+                'maxperday': int(mostperday.max(initial=0)),
+                'perday': np.bincount(mostperday.astype(np.int64)).tolist()} # Number of students by their most exams in a day
+
+    def place(self, x, y): # Moves a course to time slot y, which may be a new slot right after the last one
+        if x.slot is not None:
+            self.timeslots[x.slot].remove(x)
+        if y > self.lasttimeslotid:
+            self.lasttimeslotid = y
+            self.timeslots.update({y:[]})
+        self.timeslots[y].append(x)
+        x.slot = y
+
+    def freeslot(self, x, exclude=None): # Lowest existing time slot that none of the course's connections are in
+        used = {z.slot for z in x.connections}
+        for y in range(0,self.lasttimeslotid+1):
+            if y not in used and y != exclude and y != x.slot:
+                return y
+        return None
+
+    def repair(self, x): # Moves a course out of a conflict while leaving the rest of the schedule alone
+        y = self.freeslot(x)
+        if y is None:
+            # Otherwise look for a slot where a single connection is in the way and can be moved to another slot
+            blocking = {}
+            for z in x.connections:
+                blocking.setdefault(z.slot, []).append(z)
+            for y in range(0,self.lasttimeslotid+1):
+                if y != x.slot and len(blocking.get(y, [])) == 1:
+                    w = blocking[y][0]
+                    other = self.freeslot(w, exclude=x.slot)
+                    if other is not None:
+                        self.place(w, other)
+                        self.place(x, y)
+                        return
+            y = self.lasttimeslotid + 1 # Otherwise a new time slot is needed
+        self.place(x, y)
+
+    def trim(self): # Removes empty time slots at the end of the schedule
+        while self.lasttimeslotid > 0 and self.timeslots[self.lasttimeslotid] == []:
+            del self.timeslots[self.lasttimeslotid]
+            self.lasttimeslotid -= 1
+
+    def studentindex(self, studentid, create=False): # Internal student id of an internal id or an id from a loaded file
+        if studentid in self.studentnames:
+            return self.studentnames[studentid]
+        if isinstance(studentid, (int, np.integer)) and not isinstance(studentid, bool):
+            return int(studentid)
+        if not isinstance(studentid, str):
+            raise TypeError('Invalid student id ' + repr(studentid))
+        if not create: # Unknown students have no enrollment
+            return None
+        self.studentnames[studentid] = self.currentstudentid # New students get the next internal id, as in loadcsv()
+        self.currentstudentid += 1
+        return self.studentnames[studentid]
+
+    def enroll(self, studentid, *args): # Adds courses for a new or existing student and repairs the schedule around them
+        studentid = self.studentindex(studentid, create=True) # Checked before anything changes
+        self.currentstudentid = max(self.currentstudentid, studentid + 1)
+        courselist = self.enrollment.setdefault(studentid, set())
+        added = []
+        for arg in args:
+            course = self.catalog.get(arg)
+            if course is None:
+                course = self.addcourse(arg)
+            if course not in courselist:
+                courselist.add(course)
+                course.students.add(studentid)
+                added.append(course)
+        for x in added:
+            for z in courselist:
+                if z is not x:
+                    x.connections.add(z)
+                    z.connections.add(x)
+        self.conflicts = None # The weights from buildgraph() are out of date
+        for x in added: # Only new courses and courses that now share a slot with a connection are moved
+            if x.slot is None or any(z.slot == x.slot for z in x.connections):
+                self.repair(x)
+        self.trim()
+
+    def drop(self, studentid, *args): # Removes courses from a student, dropping edges no other student needs and moving courses down if possible
+        courselist = self.enrollment.get(self.studentindex(studentid), set())
+        affected = set()
+        for arg in args:
+            x = self.catalog.get(arg)
+            if x in courselist:
+                courselist.discard(x)
+                x.students.discard(studentid)
+                for z in courselist:
+                    if x.students.isdisjoint(z.students):
+                        x.connections.discard(z)
+                        z.connections.discard(x)
+                        affected.update([x, z])
+        self.conflicts = None
+        for x in sorted(affected, key=lambda x: -x.slot if x.slot is not None else 0):
+            y = self.freeslot(x)
+            if x.slot is not None and y is not None and y < x.slot:
+                self.place(x, y)
+        self.trim()
+
+def filekey(filename, header=True): # Hash of the contents of an enrollment file, used to name its cached graph
+    digest = hashlib.sha256(b'header' if header else b'')
+    with open(filename, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()[:32]
+
+# The coloring functions work on the connections as compressed sparse rows of course indices, so they can run in worker processes
+# slotof holds the time slot of each course (-1 if unscheduled) and is filled in place, count is the number of existing time slots,
+# and the indices of the newly scheduled courses are returned in the order they were scheduled
+
+def firstfit(indptr, indices, slotof, count): # Each course goes to the first time slot without any of its connections
+    n = len(slotof)
+    order = []
+    for i in range(n): # Catalog order, so seeded runs give the same schedule in any process
+        if slotof[i] >= 0: # Already scheduled
+            continue
+        # Only the time slots of the course's own connections are looked at, so each course costs its number of connections
+        used = slotof[indices[indptr[i]:indptr[i+1]]]
+        taken = np.zeros(count + 1, dtype=bool)
+        taken[used[used >= 0]] = True
+        y = int(taken.argmin()) # First time slot not used by a connection, or a new time slot
+        if y == count:
+            count += 1
+        slotof[i] = y
+        order.append(i)
+    return order
+
+def dsatur(indptr, indices, slotof, count): # Assigns the course whose connections already use the most time slots first (ties by most connections)
+    n = len(slotof)
+    degrees = np.diff(indptr)
+    # Courses are renumbered once by most connections, then catalog index, so among courses with the same saturation
+    # the next one is the lowest number
+    byrank = np.lexsort((np.arange(n), -degrees))
+    graph = scipy.sparse.csr_matrix((np.ones(len(indices), dtype=bool), indices, indptr), shape=(n, n))[byrank][:, byrank]
+    starts = graph.indptr.tolist()
+    connections = graph.indices
+    slots = slotof[byrank]
+    done = slots >= 0
+    # seen[y] marks the courses with a connection in time slot y, and the saturation of a course is its number of marks
+    rows = np.repeat(np.arange(n), np.diff(graph.indptr))
+    seen = []
+    for y in range(max(count, int(slots.max(initial=-1)) + 1)):
+        column = np.zeros(n, dtype=bool)
+        column[connections[slots[rows] == y]] = True
+        seen.append(column)
+    saturation = np.sum(seen, axis=0, dtype=np.int64) if seen else np.zeros(n, dtype=np.int64)
+    # waiting[s] marks the unscheduled courses with saturation s
+    waiting = np.zeros((len(seen) + 2, n), dtype=bool)
+    waiting[saturation[~done], np.flatnonzero(~done)] = True
+    top = int(saturation[~done].max(initial=0))
+    order = []
+    for _ in range(int((~done).sum())):
+        row = waiting[top]
+        i = int(row.argmax())
+        while not row[i]: # No course left with this saturation
+            top -= 1
+            row = waiting[top]
+            i = int(row.argmax())
+        row[i] = False
+        y = 0
+        for column in seen: # Lowest time slot not used by any connection
+            if not column[i]:
                 break
-            elif y == lasttimeslotid: # Otherwise create new time slot
-                lasttimeslotid += 1
-                timeslots.update({lasttimeslotid:[x]})
-    if display == True: # Print schedule
-        for i in timeslots:
-            print('Time slot ' + str(i))
-            for j in timeslots[i]:
-                print(j.name)
-        return len(timeslots)
-
-from random import *
+            y += 1
+        if y == len(seen):
+            seen.append(np.zeros(n, dtype=bool))
+            waiting = np.concatenate([waiting, np.zeros((1, n), dtype=bool)])
+        slots[i] = y
+        done[i] = True
+        order.append(i)
+        # Saturation only changes for unscheduled connections that had not seen this slot
+        column = seen[y]
+        j = connections[starts[i]:starts[i+1]]
+        j = j[~(column[j] | done[j])]
+        if len(j) == 0:
+            continue
+        column[j] = True
+        s = saturation[j]
+        waiting[s, j] = False
+        s += 1
+        waiting[s, j] = True
+        saturation[j] = s
+        top += 1 # Rows without courses are skipped, so top may be one above the highest saturation
+    slotof[byrank] = slots
+    return byrank[order].tolist()
+
+# The local search functions use the number of students shared by each pair of connected courses as weights,
+# and return the best valid time slot of each course found before the deadline (or a keyboard interrupt)
+
+def slotweights(indptr, indices, weights, slotof, count): # Course by time slot matrix of the students shared with the courses in each slot
+    rows = np.repeat(np.arange(len(slotof)), np.diff(indptr))
+    return np.bincount(rows * count + slotof[indices], weights=weights, minlength=len(slotof) * count).astype(np.int64).reshape(-1, count)
+
+def removeslots(indptr, indices, weights, slotof, deadline, rng): # Empties the last time slot with tabu search (TabuCol), one slot at a time
+    n = len(slotof)
+    everyone = np.arange(n)
+    best = slotof.copy()
+    s = slotof.copy()
+    count = int(s.max()) + 1
+    never = np.iinfo(np.int64).max
+    try:
+        while count > 1 and perf_counter() < deadline:
+            # Courses of the last time slot go to the slot where they clash with the fewest students
+            shared = slotweights(indptr, indices, weights, s, count)
+            for i in np.flatnonzero(s == count - 1).tolist():
+                y = int(np.argmin(shared[i, :count-1]))
+                j = indices[indptr[i]:indptr[i+1]]
+                shared[j, s[i]] -= weights[indptr[i]:indptr[i+1]]
+                shared[j, y] += weights[indptr[i]:indptr[i+1]]
+                s[i] = y
+            count -= 1
+            shared = shared[:, :count].copy()
+            # Then courses in a clash move to the slot that lowers the clashes most, and may not move back for a while
+            clashes = int(shared[everyone, s].sum()) // 2
+            fewest = clashes
+            tabu = np.zeros((n, count), dtype=np.int64)
+            iteration = 0
+            while clashes > 0 and perf_counter() < deadline:
+                current = shared[everyone, s]
+                clashing = np.flatnonzero(current > 0)
+                change = shared[clashing] - current[clashing, None]
+                change[np.arange(len(clashing)), s[clashing]] = never
+                change[(tabu[clashing] > iteration) & (clashes + change >= fewest)] = never # Tabu unless it beats the best so far
+                lowest = change.min()
+                if lowest == never: # Every move is tabu
+                    r, y = rng.integers(len(clashing)), rng.integers(count)
+                else:
+                    r, y = divmod(int(rng.choice(np.flatnonzero(change == lowest))), count)
+                i = clashing[r]
+                if y == s[i]:
+                    continue
+                clashes += int(shared[i, y] - shared[i, s[i]])
+                tabu[i, s[i]] = iteration + rng.integers(10) + int(0.6 * len(clashing))
+                j = indices[indptr[i]:indptr[i+1]]
+                shared[j, s[i]] -= weights[indptr[i]:indptr[i+1]]
+                shared[j, y] += weights[indptr[i]:indptr[i+1]]
+                s[i] = y
+                fewest = min(fewest, clashes)
+                iteration += 1
+            if clashes > 0: # Out of time before the slot could be removed
+                break
+            best = s.copy()
+    except KeyboardInterrupt:
+        pass
+    return best
+
+def spreadexams(indptr, indices, weights, slotof, slotsperday, deadline, rng): # Reduces back-to-back exams without adding time slots
+    n = len(slotof)
+    everyone = np.arange(n)
+    count = int(slotof.max()) + 1
+    sameday = (np.arange(1, count) // slotsperday) == (np.arange(count - 1) // slotsperday) # Whether slot y and y+1 are on the same day
+    s = slotof.copy()
+    try:
+        # Any order of the time slots is valid, so first whole time slots are swapped while that lowers the back-to-back exams
+        rows = np.repeat(everyone, np.diff(indptr))
+        between = np.bincount(s[rows] * count + s[indices], weights=weights, minlength=count * count).reshape(count, count)
+        order = np.arange(count) # Time slot at each position
+        cost = between[order[:-1], order[1:]][sameday].sum()
+        improved = True
+        while improved and perf_counter() < deadline:
+            improved = False
+            for p in range(count):
+                for q in range(p + 1, count):
+                    order[[p, q]] = order[[q, p]]
+                    swapped = between[order[:-1], order[1:]][sameday].sum()
+                    if swapped < cost:
+                        cost = swapped
+                        improved = True
+                    else:
+                        order[[p, q]] = order[[q, p]]
+        position = np.empty(count, dtype=np.int64)
+        position[order] = np.arange(count)
+        s = position[s]
+        best = s.copy()
+        # Then single courses move to slots without any of their connections, with tabu search
+        adjacent = np.zeros((count, count), dtype=np.int64)
+        adjacent[np.flatnonzero(sameday), np.flatnonzero(sameday) + 1] = 1
+        adjacent += adjacent.T
+        shared = slotweights(indptr, indices, weights, s, count)
+        penalty = shared @ adjacent # Back-to-back exams each course would have in each time slot
+        total = int(penalty[everyone, s].sum()) // 2
+        fewest = total
+        never = np.iinfo(np.int64).max
+        tabu = np.zeros((n, count), dtype=np.int64)
+        iteration = 0
+        while total > 0 and perf_counter() < deadline:
+            current = penalty[everyone, s]
+            candidates = np.flatnonzero(current > 0)
+            change = penalty[candidates] - current[candidates, None]
+            change[shared[candidates] > 0] = never # Slots with a connection would create a conflict
+            change[np.arange(len(candidates)), s[candidates]] = never
+            possible = change < never
+            if not possible.any(): # No course can move without a conflict, so the search is stuck
+                break
+            change[(tabu[candidates] > iteration) & (total + change >= fewest)] = never
+            lowest = change.min()
+            iteration += 1
+            if lowest == never: # Every possible move is tabu, so skip ahead to when the first one is allowed again
+                iteration = int(tabu[candidates][possible].min())
+                continue
+            r, y = divmod(int(rng.choice(np.flatnonzero(change == lowest))), count)
+            i = candidates[r]
+            total += int(lowest)
+            tabu[i, s[i]] = iteration + rng.integers(10) + int(0.6 * len(candidates))
+            j = indices[indptr[i]:indptr[i+1]]
+            w = weights[indptr[i]:indptr[i+1]]
+            shared[j, s[i]] -= w
+            shared[j, y] += w
+            penalty[j] += w[:, None] * (adjacent[y] - adjacent[s[i]])
+            s[i] = y
+            if total < fewest:
+                fewest = total
+                best = s.copy()
+    except KeyboardInterrupt:
+        pass
+    return best
+
+def colorsubgraph(args): # Time slot of each course of a subgraph, starting from time slot 0
+    indptr, indices, method = args
+    slotof = np.full(len(indptr) - 1, -1)
+    (dsatur if method == 'dsatur' else firstfit)(indptr, indices, slotof, 1)
+    return slotof
+
+# Default scheduler used by the interactive program
+scheduler = examscheduler()
+addstudent = scheduler.addstudent
+buildgraph = scheduler.buildgraph
+schedule = scheduler.schedule
+enroll = scheduler.enroll
+drop = scheduler.drop
+loadcsv = scheduler.loadcsv
+
+from random import Random
 from time import *
 import re
+import sys
+import tracemalloc
 from matplotlib import pyplot as plt
 
-def simulate(listing,students,courseload):
-    global enrollment
-    global timeslots
-    global currentstudentid
-    global lasttimeslotid
-    global courses
-    enrollment = {}
-    timeslots = {0: []}
-    currentstudentid = 0
-    lasttimeslotid = 0
-    courses = set()
+def enrollmentmatrix(listing, students, courseload, popularity=0, majors=0, majorshare=0.5, seed=None):
+    # Student by courseload array of distinct course names from 0 to the listing value
+    # Popularity is the exponent of a Zipf-like weight 1/(course+1)^popularity (0 for uniform)
+    # With majors, each student has a major owning a block of courses, and draws about majorshare of their courses from it
+    if courseload > listing + 1:
+        raise ValueError('Course load ' + str(courseload) + ' is larger than the ' + str(listing + 1) + ' courses in the listing')
+    if majors > listing + 1:
+        raise ValueError(str(majors) + ' majors cannot each own a block of the ' + str(listing + 1) + ' courses in the listing')
+    if not 0 <= majorshare <= 1:
+        raise ValueError('Invalid majorshare ' + str(majorshare))
+    rng = np.random.default_rng(seed)
+    n = listing + 1
+    weights = 1 / np.arange(1, n+1) ** popularity
+    weights /= weights.sum()
+    rng.shuffle(weights) # Popular courses are spread over the listing instead of being the lowest numbers
+    if majors > 0:
+        major = rng.integers(0, majors, size=students)
+        block = np.arange(n) * majors // n # Major that owns each course
+        distributions = np.empty((majors, n))
+        for m in range(majors):
+            owned = np.where(block == m, weights, 0)
+            distributions[m] = (1 - majorshare) * weights + majorshare * owned / owned.sum()
+    else:
+        major = np.zeros(students, dtype=np.int64)
+        distributions = weights[None, :]
+    available = (distributions > 0).sum(axis=1).min()
+    if courseload > available: # Otherwise some students could never get enough distinct courses
+        raise ValueError('Course load ' + str(courseload) + ' is larger than the ' + str(available) + ' courses a student can draw from')
+    matrix = np.empty((students, courseload), dtype=np.int64)
+    for m in range(len(distributions)):
+        rows = np.flatnonzero(major == m)
+        matrix[rows] = rng.choice(n, size=(len(rows), courseload), p=distributions[m])
+    # Courses are drawn one column at a time, and a course the student already has is drawn again
+    # in that column only, which is the same as drawing without replacement
+    for column in range(1, courseload):
+        redraw = np.flatnonzero((matrix[:,:column] == matrix[:,column,None]).any(axis=1))
+        while len(redraw) > 0:
+            for m in np.unique(major[redraw]):
+                rows = redraw[major[redraw] == m]
+                matrix[rows,column] = rng.choice(n, size=len(rows), p=distributions[m])
+            redraw = redraw[(matrix[redraw,:column] == matrix[redraw,column,None]).any(axis=1)]
+    return matrix
+
+def simulate(listing,students,courseload,sparse=False,method='firstfit',seed=None,display=True,vectorized=False,popularity=0,majors=0):
+    # Sparse builds the graph with buildgraph(), and vectorized draws all enrollments at once with enrollmentmatrix()
+    random = Random(seed) # Own generator and scheduler, so simulations in separate processes are independent
+    scheduler = examscheduler()
     starttime = time()
-    for i in range(0,students): # Create random student
-        studentcourses = []
-        for j in range(0,courseload): # Each student has a number of courses specified by courseload
-            a = randint(0,listing) # Course names are random numbers from 0 to the listing value
-            while a in studentcourses: # Prevents assigning the same course twice to the same student
-                a = randint(0, listing)
-            studentcourses.append(randint(0,listing))
-        addstudent(*studentcourses)
-    slots = schedule(display=True) # Calculate the schedule
+    if vectorized:
+        scheduler.addenrollment(enrollmentmatrix(listing, students, courseload, popularity, majors, seed=seed))
+    else:
+        for i in range(0,students): # Create random student
+            studentcourses = []
+            for j in range(0,courseload): # Each student has a number of courses specified by courseload
+                a = random.randint(0,listing) # Course names are random numbers from 0 to the listing value
+                while a in studentcourses: # Prevents assigning the same course twice to the same student
+                    a = random.randint(0, listing)
+                studentcourses.append(random.randint(0,listing))
+            scheduler.addstudent(*studentcourses, connect=not sparse)
+        if sparse:
+            scheduler.buildgraph()
+    slots = scheduler.schedule(display=display, method=method) # Calculate the schedule
     endtime = time()
-    print(endtime - starttime, 'seconds to calculate.')
+    if display:
+        print(endtime - starttime, 'seconds to calculate.')
     return endtime - starttime, slots
 
-def montecarlo(variable, start, steps, stepsize, coursedefault = 1000, studentdefault = 1000, loaddefault = 4):
+def trial(args): # One simulation of a Monte Carlo run, at module level so it can be sent to worker processes
+    return simulate(*args)
+
+def montecarlo(variable, start, steps, stepsize, coursedefault = 1000, studentdefault = 1000, loaddefault = 4, method = 'firstfit',
+               trials = 1, processes = 1, seed = None, display = True, vectorized = False, popularity = 0, majors = 0):
     xaxis = [a for a in range(start,start+steps*stepsize, stepsize)]
-    times = []
-    slots = []
-    if variable == 'courses':
-        for i in range(steps):
-            t, s = simulate(start+i*stepsize, studentdefault, loaddefault)
-            times.append(t)
-            slots.append(s)
-    elif variable == 'students':
-        for i in range(steps):
-            t, s = simulate(coursedefault, start+i*stepsize, loaddefault)
-            times.append(t)
-            slots.append(s)
-    elif variable == 'courseload':
-        for i in range(steps):
-            t, s = simulate(coursedefault, studentdefault, start+i*stepsize)
-            times.append(t)
-            slots.append(s)
-    fig, ax = plt.subplots(1,2)
-    ax[0].plot(xaxis, times)
-    ax[0].set_ylabel('Time (s)')
-    ax[0].set_xlabel(variable)
-    ax[1].plot(xaxis, slots)
-    ax[1].set_ylabel('Time Slots')
-    ax[1].set_xlabel(variable)
-    plt.show()
-
-if __name__ == '__main__':
-    simulation = input('Random Simulation? (yes/no): ')
-    if simulation == 'yes':
+    # Every trial of every step gets its own seed, so results do not depend on the number of processes
+    seeds = [int(x.generate_state(1)[0]) for x in np.random.SeedSequence(seed).spawn(steps*trials)]
+    jobs = []
+    for i in range(steps):
+        value = start+i*stepsize
+        if variable == 'courses':
+            parameters = (value, studentdefault, loaddefault)
+        elif variable == 'students':
+            parameters = (coursedefault, value, loaddefault)
+        elif variable == 'courseload':
+            parameters = (coursedefault, studentdefault, value)
+        else:
+            raise ValueError('Invalid variable ' + str(variable))
+        for j in range(trials):
+            jobs.append(parameters + (False, method, seeds[i*trials+j], False, vectorized, popularity, majors))
+    if processes > 1:
+        with Pool(processes) as pool:
+            results = pool.map(trial, jobs)
+    else:
+        results = [trial(x) for x in jobs]
+    results = np.array(results).reshape(steps, trials, 2)
+    times = results[:,:,0].mean(axis=1) # Average over trials
+    slots = results[:,:,1].mean(axis=1)
+    if display:
+        fig, ax = plt.subplots(1,2)
+        ax[0].plot(xaxis, times)
+        ax[0].set_ylabel('Time (s)')
+        ax[0].set_xlabel(variable)
+        ax[1].plot(xaxis, slots)
+        ax[1].set_ylabel('Time Slots')
+        ax[1].set_xlabel(variable)
+        plt.show()
+    return xaxis, times, slots
+
+def benchmarkphases(listing, students, courseload, method, seed): # Seconds spent in each phase of one scheduling run
+    times = {}
+    start = perf_counter()
+    scheduler = examscheduler()
+    for i in range(listing + 1):
+        scheduler.addcourse(i)
+    times['catalog'] = perf_counter() - start
+    start = perf_counter()
+    scheduler.addenrollment(enrollmentmatrix(listing, students, courseload, seed=seed), connect=False)
+    times['enrollment'] = perf_counter() - start
+    start = perf_counter()
+    scheduler.buildgraph()
+    times['graph'] = perf_counter() - start
+    start = perf_counter()
+    slots = scheduler.schedule(display=False, method=method)
+    times['coloring'] = perf_counter() - start
+    start = perf_counter()
+    stats = scheduler.validate()
+    times['validation'] = perf_counter() - start
+    return times, slots, stats
+
+def benchmarkmemory(listing, students, courseload, method, seed): # Peak traced memory in MB of each phase of one scheduling run
+    peaks = {}
+    tracemalloc.start()
+    def phase(name):
+        peaks[name] = tracemalloc.get_traced_memory()[1] / 2**20
+        tracemalloc.reset_peak()
+    scheduler = examscheduler()
+    for i in range(listing + 1):
+        scheduler.addcourse(i)
+    phase('catalog')
+    scheduler.addenrollment(enrollmentmatrix(listing, students, courseload, seed=seed), connect=False)
+    phase('enrollment')
+    scheduler.buildgraph()
+    phase('graph')
+    scheduler.schedule(display=False, method=method)
+    phase('coloring')
+    scheduler.validate()
+    phase('validation')
+    tracemalloc.stop()
+    return peaks
+
+def benchmark(students=(1000, 10000, 100000), courseloads=(3, 5, 7), listing=1000, method='firstfit', repeats=3, seed=0, filename=None):
+    # Times every phase separately over a grid of student counts and course loads, and writes the results as JSON or CSV
+    # Times are the fastest of the repeats, and memory is measured in a separate run because tracing slows everything down
+    phases = ['catalog', 'enrollment', 'graph', 'coloring', 'validation']
+    results = []
+    for count in students:
+        for courseload in courseloads:
+            runs = [benchmarkphases(listing, count, courseload, method, seed) for i in range(repeats)]
+            peaks = benchmarkmemory(listing, count, courseload, method, seed)
+            result = {'students': count, 'courseload': courseload, 'courses': listing + 1, 'method': method}
+            for name in phases:
+                result[name + 'time'] = min(x[0][name] for x in runs)
+            result['totaltime'] = sum(result[name + 'time'] for name in phases)
+            for name in phases:
+                result[name + 'memory'] = peaks[name]
+            result['peakmemory'] = max(peaks.values())
+            result['timeslots'] = runs[0][1]
+            result['valid'] = runs[0][2]['valid']
+            result['backtoback'] = runs[0][2]['backtoback']
+            results.append(result)
+            print(count, 'students,', courseload, 'courses each:', ', '.join(name + ' %.3fs' % result[name + 'time'] for name in phases),
+                  '(peak %.1f MB)' % result['peakmemory'])
+    if filename is not None:
+        with open(filename, 'w', newline='') as file:
+            if filename.endswith('.csv'):
+                writer = csv.DictWriter(file, fieldnames=list(results[0]))
+                writer.writeheader()
+                writer.writerows(results)
+            else:
+                json.dump(results, file, indent=1)
+    return results
+
+if __name__ == '__main__' and len(sys.argv) > 1 and sys.argv[1] == 'benchmark':
+    # python FinalExamScheduler.py benchmark [results.json or results.csv]
+    benchmark(filename=sys.argv[2] if len(sys.argv) > 2 else None)
+elif __name__ == '__main__':
+    simulation = input('Random Simulation? (yes/no/csv): ')
+    if simulation == 'csv':
+        loadcsv(input('Enrollment file (student_id, course): '))
+        schedule()
+    elif simulation == 'yes':
         single = input('Single Simulation? (yes/no): ')
         if single == 'yes':
             listing = int(input('Number of courses:'))
@@ -136,7 +866,9 @@ if __name__ == '__main__':
                 start = int(input('Start Value: '))
                 steps = int(input('Steps: '))
                 stepsize = int(input('Step Size: '))
-                montecarlo(var,start, steps,stepsize,coursedefault, studentdefault, loaddefault)
+                trials = int(input('Trials per step: '))
+                processes = int(input('Processes: '))
+                montecarlo(var,start, steps,stepsize,coursedefault, studentdefault, loaddefault, trials=trials, processes=processes)
     else:
         print('Type a comma separated list for each new student, or "done" if finished.')
         userinput= None
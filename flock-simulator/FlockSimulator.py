@@ -3,137 +3,975 @@ This is a simple simulation of a flock of birds trapped in a box.
 Each bird in the flock moves to maintain an optimal distance from its neighbors.
 Right-Click to start and stop the animation.
 Left-Click to chase the flock around the box.
+Shift-Left-Click to release a predator that flies around the box on its own.
+Press P to show the time spent in each part of the loop.
+Run with arguments (ticks, filename and optionally flock size and worker processes) to simulate without a window.
 '''
 
 from tkinter import *
-from random import *
 from math import *
-from numpy.random import multivariate_normal
+import numpy as np
 import time
+import sys
+import threading
+import multiprocessing
+from multiprocessing import shared_memory
+import itertools
+import csv
+import json
+import collections
 
-window = Tk(className = ' Flock')
-canvas = Canvas(window, width=1200, height=800)
-canvas.pack(fill=BOTH, expand=True )
+window = None # Window and canvas are only created when the animation is run
+canvas = None
 
 r = 3 # Bird size
 size = 2000 # Flock size
+spread = 2000 # Variance of the initial bird positions
 randstep = 5 # Random component of bird movement
 ovals = [] # List of birds
-directions = [] # Last direction of each bird
+renderer = 'auto' # Drawing mode: 'oval' (one canvas item per bird), 'raster' (one image of the whole flock) or 'auto'
+rasterthreshold = 1000 # Flock size above which the automatic mode draws an image
+frame = None # Image buffer of the raster mode
+photo = None
+image = None # Canvas item showing the image
+positions = np.zeros((0,2)) # Position of each bird
+directions = np.zeros((0,2)) # Last direction of each bird
+nextpositions = np.zeros((0,2)) # Buffers the next step is written into before they are swapped in
+nextdirections = np.zeros((0,2))
+chunk = 64 # Number of birds per block of the pairwise distance calculation
+forcemode = 'exact' # Bird to bird calculation: 'exact' (all pairs), 'grid' (neighbors within the cutoff) or 'barneshut'
+cutoff = None # Interaction radius in grid mode (None is twice the optimal distance)
+theta = 0.5 # Opening angle in Barnes-Hut mode (larger is faster but less accurate)
+leafsize = 16 # Average number of birds per leaf cell of the Barnes-Hut quadtree
+multirate = False # Recalculate the bird to bird component of settled birds less often
+lodrate = 4 # Settled birds recalculate it every lodrate steps, in staggered groups
+lodtolerance = 0.05 # Error of the held sum of unit vectors, per bird in the sum, below which a bird counts as settled
+lodmargin = 100 # Birds closer than this to a wall, or within predthreshold of a predator, always update
+heldunits = None # Sum of unit vectors to the other birds when the bird to bird component was last calculated
+heldoffsets = None # Grid mode: offset part of the component, number of birds within the cutoff,
+heldcounts = None # and center of the birds in the surrounding cells when it was calculated
+heldcenters = None
+heldpositions = None # Position of each bird when it was calculated
+settled = None # Birds updated at the lower rate
+heldnames = ['heldunits', 'heldoffsets', 'heldcounts', 'heldcenters', 'heldpositions', 'settled']
 dirchange = 0.95 # Contribution from previous direction
-predators = None # Predator, which birds will flay away from
+predators = [] # Predators, which birds will flay away from
 predthreshold = 1000 # Distance at which birds will not respond to predators
+predindex = 32 # Number of predators above which they are sorted into a grid before the avoidance pass
+predspeed = 15 # Speed of autonomous predators
 wallthreshold = 500
 lenthreshold = 50 # Maximum length a bird can move at one time
 flightthreshold = 20 # Minimum length a bird must fly to stay air born
 width = 100 # Optimal bird to bird distance
+boxwidth = 1200 # Box dimensions
+boxheight = 800
+seed = None # Seed of the random streams (None draws one from the operating system)
+generators = {} # Independent random streams for generating birds, flight and predators
+steps = 0 # Number of steps simulated
 animating = False # Animation state
+profiling = False # Record the time spent in each phase of the loop
+overlay = False # Show the rolling profile on the canvas
+profilelength = 120 # Number of recent samples kept for each phase
+profile = {} # Recent durations of each phase in seconds
+overlaytext = None # Canvas item showing the profile
+timestep = 1/30 # Seconds of real time per physics step
+maxsubsteps = 4 # Most physics steps run to catch up before a frame is drawn, the rest of the lag is dropped
+threaded = False # Run the physics on a worker thread that publishes snapshots of the positions
+lasttime = 0 # Time of the last scheduler tick
+lag = 0 # Real time not yet simulated
+job = None # Pending scheduler callback
+snapshot = None # Latest positions published by the worker thread
+snapshotlock = threading.Lock()
+worker = None # Physics thread
+
+# Creates the random streams from one seed, so a run can be reproduced exactly
+def reseed(value=None):
+    global seed
+    seed = value
+    for name, sequence in zip(['flock', 'flight', 'predators'], np.random.SeedSequence(value).spawn(3)):
+        generators[name] = np.random.Generator(np.random.PCG64(sequence))
+
+reseed(seed)
 
 # Generates n birds
 def generate(n, x, y):
-    global ovals
+    global positions
     global directions
-    for i in range(n):
-        coord = multivariate_normal([x,y],[[size,0],[0,size]])
-        ovals.append(canvas.create_oval(coord[0]-r, coord[1]-r, coord[0]+r, coord[1]+r, fill='#000000'))
-        directions.append([0,0])
+    global nextpositions
+    global nextdirections
+    coords = generators['flock'].multivariate_normal([x,y],[[spread,0],[0,spread]],n)
+    positions = np.concatenate([positions, coords])
+    directions = np.concatenate([directions, np.zeros((n,2))])
+    nextpositions = np.empty_like(positions)
+    nextdirections = np.empty_like(directions)
+    if canvas is not None:
+        draw()
 
-# Calculates direction and magnitude of a bird's flight vector
-def neighbors(a):
-    global directions
-    ovalindex = ovals.index(a)
-    vectors = []
-    # Maintaining bird to bird distance
-    for b in ovals:
-        if b !=a:
-            xdist = canvas.coords(b)[0] - canvas.coords(a)[0]
-            ydist = canvas.coords(b)[1] - canvas.coords(a)[1]
-            dist = sqrt(xdist ** 2 + ydist ** 2)
-            magnitude = dist - width
-            vectors.append([magnitude * xdist / dist, magnitude * ydist / dist])
-    # Flying away from box edges
-    maxx = canvas.winfo_width()
-    maxy = canvas.winfo_height()
-    wallxdist1 = maxx - canvas.coords(a)[0]
-    wallxdist2 = 0 - canvas.coords(a)[0]
-    wallydist1 = maxy - canvas.coords(a)[1]
-    wallydist2 = 0 - canvas.coords(a)[1]
-    magnitudex = -100000*(1/wallxdist1+1/wallxdist2)
-    magnitudey = -100000*(1/wallydist1+1/wallydist2)
-    vectors.append([magnitudex, magnitudey])
-    # Flying away from predators
+# Maintaining bird to bird distance, summed over all pairs one block of birds at a time
+# Each pair contributes (dist - width) * offset / dist = offset - width * offset / dist,
+# and the offsets alone sum to the flock total minus n times the bird's own position
+# The force is calculated for the birds at the query indices (all birds by default)
+def spacing(pos, query=None):
+    querypos = pos if query is None else pos[query]
+    force = pos.sum(axis=0) - len(pos) * querypos
+    for i in range(0, len(querypos), chunk):
+        xdist = pos[:,0] - querypos[i:i+chunk,0,None]
+        ydist = pos[:,1] - querypos[i:i+chunk,1,None]
+        scale = xdist * xdist
+        scale += ydist * ydist
+        np.sqrt(scale, out=scale)
+        # A bird exerts no force on itself (zero distance)
+        np.divide(width, scale, out=scale, where=scale>0)
+        force[i:i+chunk,0] -= (scale * xdist).sum(axis=1)
+        force[i:i+chunk,1] -= (scale * ydist).sum(axis=1)
+    return force
+
+# Sorts birds into square cells so the birds in any cell are a contiguous slice of the order
+def buildgrid(pos, cellsize):
+    if len(pos) == 0: # No birds, so no cells
+        empty = np.zeros(0, dtype=np.int64)
+        return np.zeros(2, dtype=np.int64), np.zeros(2, dtype=np.int64), empty, empty, empty
+    cell = np.floor(pos / cellsize).astype(np.int64)
+    origin = cell.min(axis=0)
+    cell -= origin
+    shape = cell.max(axis=0) + 1
+    ids = cell[:,0] * shape[1] + cell[:,1]
+    order = np.argsort(ids, kind='stable')
+    counts = np.bincount(ids, minlength=shape[0] * shape[1])
+    starts = np.cumsum(counts) - counts
+    return origin, shape, order, starts, counts
+
+# Pairs every queried cell with the birds in the cell at offset (dx, dy) from it
+def cellpairs(cell, shape, order, starts, counts, dx, dy):
+    nx = cell[:,0] + dx
+    ny = cell[:,1] + dy
+    query = np.flatnonzero((nx >= 0) & (nx < shape[0]) & (ny >= 0) & (ny < shape[1]))
+    ids = nx[query] * shape[1] + ny[query]
+    n = counts[ids]
+    total = n.sum()
+    offset = np.arange(total) - np.repeat(np.cumsum(n) - n, n)
+    return np.repeat(query, n), order[np.repeat(starts[ids], n) + offset]
+
+# Maintaining bird to bird distance with only the birds within the cutoff radius
+# The grid is rebuilt every step with cells the size of the optimal distance
+# Query birds are taken in blocks of up to chunk birds from one column of cells and a band of a few rows, and the birds in the
+# neighboring cells of a block are a contiguous slice of the sorted birds for each column, so every block
+# is a dense calculation like spacing() and memory stays bounded
+# The force is calculated for the birds at the query indices (all birds by default)
+# With parts, the sum of unit vectors and the number of birds within the cutoff are also returned for each query bird
+def gridspacing(pos, query=None, parts=False):
+    radius = cutoff if cutoff else 2 * width
+    reach = int(ceil(radius / width))
+    querypos = pos if query is None else pos[query]
+    if len(querypos) == 0: # Nothing to calculate, which is normal for an empty strip of the parallel simulation
+        empty = np.zeros((0,2))
+        return (empty, empty.copy(), np.zeros(0, dtype=np.int64)) if parts else empty
+    origin, shape, order, starts, counts = buildgrid(pos, width)
+    ends = starts + counts
+    sortedpos = pos[order]
+    cell = np.floor(querypos / width).astype(np.int64) - origin
+    queryorder = np.argsort(cell[:,0] * shape[1] + cell[:,1], kind='stable')
+    column = cell[queryorder,0]
+    row = cell[queryorder,1]
+    band = row // (2 * reach + 1)
+    bounds = np.union1d(np.arange(0, len(querypos), chunk), np.flatnonzero(np.diff(column) | np.diff(band)) + 1).tolist() + [len(querypos)]
+    force = np.zeros_like(querypos)
+    units = np.zeros_like(querypos)
+    neighbors = np.zeros(len(querypos), dtype=np.int64)
+    for a, b in zip(bounds[:-1], bounds[1:]):
+        x = column[a]
+        low = max(row[a] - reach, 0)
+        high = min(row[b-1] + reach, shape[1] - 1)
+        near = np.concatenate([sortedpos[starts[(x+dx)*shape[1]+low]:ends[(x+dx)*shape[1]+high]]
+                               for dx in range(-reach, reach + 1) if 0 <= x + dx < shape[0]])
+        block = queryorder[a:b]
+        xdist = near[:,0] - querypos[block,0,None]
+        ydist = near[:,1] - querypos[block,1,None]
+        scale = xdist * xdist
+        scale += ydist * ydist
+        np.sqrt(scale, out=scale)
+        # Birds outside the cutoff, and the bird itself, exert no force
+        # Inside it the force is the sum of offsets minus width times the sum of unit vectors
+        inside = scale < radius
+        inside &= scale > 0
+        np.divide(1, scale, out=scale, where=inside)
+        scale *= inside
+        total = scale.sum(axis=1)
+        units[block] = scale @ near - total[:,None] * querypos[block]
+        scale[:] = inside
+        neighbors[block] = inside.sum(axis=1)
+        force[block] = scale @ near - neighbors[block,None] * querypos[block] - width * units[block]
+    if parts:
+        return force, units, neighbors
+    return force
+
+# Center of the birds in the cells within the cutoff reach around each bird's cell, from a summed area table of the grid
+def neighborhoodcenters(pos):
+    if len(pos) == 0:
+        return np.zeros((0,2))
+    radius = cutoff if cutoff else 2 * width
+    reach = int(ceil(radius / width))
+    cell = np.floor(pos / width).astype(np.int64)
+    cell -= cell.min(axis=0)
+    shape = cell.max(axis=0) + 1
+    ids = cell[:,0] * shape[1] + cell[:,1]
+    sums = []
+    for weights in (None, pos[:,0], pos[:,1]):
+        table = np.bincount(ids, weights, shape[0] * shape[1]).reshape(shape)
+        table = np.pad(table, ((reach + 1, reach), (reach + 1, reach))).cumsum(axis=0).cumsum(axis=1)
+        k = 2 * reach + 1
+        sums.append((table[k:,k:] - table[:-k,k:] - table[k:,:-k] + table[:-k,:-k])[cell[:,0], cell[:,1]])
+    return np.stack([sums[1], sums[2]], axis=1) / sums[0][:,None]
+
+# Builds a quadtree over the bounding square of the flock one level at a time
+# Each level holds the sorted ids of its occupied cells, the cell of every bird, and the bird count and center of mass of every cell
+def buildquadtree(pos):
+    origin = pos.min(axis=0)
+    side = max((pos.max(axis=0) - origin).max() * (1 + 1e-9), 1.0)
+    depth = max(1, min(20, int(ceil(log(max(len(pos) / leafsize, 1), 4)))))
+    levels = []
+    for level in range(depth + 1):
+        n = 2 ** level
+        cell = np.minimum(((pos - origin) * (n / side)).astype(np.int64), n - 1)
+        ids, inverse, counts = np.unique(cell[:,0] * n + cell[:,1], return_inverse=True, return_counts=True)
+        com = np.empty((len(ids), 2))
+        com[:,0] = np.bincount(inverse, pos[:,0]) / counts
+        com[:,1] = np.bincount(inverse, pos[:,1]) / counts
+        levels.append((ids, inverse, counts, com))
+    return side, levels
+
+# Maintaining bird to bird distance with distant groups of birds approximated by their center of mass
+# The offset part of the spacing force is exact, only the sum of unit vectors to other birds uses the quadtree
+def barneshut(pos, query=None):
+    birds = np.arange(len(pos)) if query is None else np.asarray(query, dtype=np.int64)
+    if len(birds) == 0: # Nothing to calculate
+        return np.zeros((0,2))
+    side, levels = buildquadtree(pos)
+    querypos = pos[birds]
+    units = np.zeros_like(querypos)
+    query = np.arange(len(birds))
+    node = np.zeros(len(birds), dtype=np.int64)
+    for level, (ids, inverse, counts, com) in enumerate(levels):
+        xdist = com[node,0] - querypos[query,0]
+        ydist = com[node,1] - querypos[query,1]
+        dist = np.sqrt(xdist ** 2 + ydist ** 2)
+        # A cell far enough away is treated as all of its birds at the center of mass
+        far = (side / 2 ** level < theta * dist) & (node != inverse[birds[query]])
+        scale = counts[node[far]] / dist[far]
+        units[:,0] += np.bincount(query[far], scale * xdist[far], len(birds))
+        units[:,1] += np.bincount(query[far], scale * ydist[far], len(birds))
+        query = query[~far]
+        node = node[~far]
+        if level == len(levels) - 1:
+            break
+        # Otherwise the cell is opened and its occupied children are evaluated at the next level
+        childids = levels[level + 1][0]
+        ix = ids[node] // 2 ** level
+        iy = ids[node] % 2 ** level
+        queries = []
+        nodes = []
+        for a in (0, 1):
+            for b in (0, 1):
+                child = (2 * ix + a) * 2 ** (level + 1) + 2 * iy + b
+                k = np.minimum(np.searchsorted(childids, child), len(childids) - 1)
+                found = childids[k] == child
+                queries.append(query[found])
+                nodes.append(k[found])
+        query = np.concatenate(queries)
+        node = np.concatenate(nodes)
+    # Leaf cells that are still too close are summed bird by bird, in blocks of about as many pairs as a block of spacing()
+    ids, inverse, counts, com = levels[-1]
+    order = np.argsort(inverse, kind='stable')
+    starts = np.cumsum(counts) - counts
+    ends = np.cumsum(counts[node])
+    budget = chunk * len(pos)
+    bounds = np.unique(np.concatenate([[0], np.searchsorted(ends, np.arange(budget, ends[-1] if len(ends) else 0, budget)), [len(node)]]))
+    for i, j in zip(bounds[:-1], bounds[1:]):
+        n = counts[node[i:j]]
+        offset = np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)
+        a = np.repeat(query[i:j], n)
+        b = order[np.repeat(starts[node[i:j]], n) + offset]
+        xdist = pos[b,0] - querypos[a,0]
+        ydist = pos[b,1] - querypos[a,1]
+        dist = np.sqrt(xdist ** 2 + ydist ** 2)
+        keep = dist > 0
+        units[:,0] += np.bincount(a[keep], xdist[keep] / dist[keep], len(birds))
+        units[:,1] += np.bincount(a[keep], ydist[keep] / dist[keep], len(birds))
+    return pos.sum(axis=0) - len(pos) * querypos - width * units
+
+# Error of the Barnes-Hut spacing force relative to the exact all pairs force over the whole flock
+def barneshuterror(pos=None):
+    if pos is None:
+        pos = positions
+    exact = spacing(pos)
+    return np.sqrt(((barneshut(pos) - exact) ** 2).sum() / (exact ** 2).sum())
+
+# Flying away from box edges
+def walls(pos, maxx, maxy):
+    force = np.empty_like(pos)
+    force[:,0] = -100000*(1/(maxx - pos[:,0]) + 1/(0 - pos[:,0]))
+    force[:,1] = -100000*(1/(maxy - pos[:,1]) + 1/(0 - pos[:,1]))
+    return force
+
+# Pairs of birds and predators within predthreshold of each other, with their offsets and distances
+# Pairs are only measured once they pass the cheaper predthreshold box test
+# With many predators, each bird is only paired with the predators in the grid cells (of size predthreshold) around it
+def predatorpairs(pos):
+    pred = np.array([[p.x, p.y] for p in predators], dtype=float).reshape(-1, 2)
+    if len(pred) > predindex:
+        origin, shape, order, starts, counts = buildgrid(pred, predthreshold)
+        cell = np.floor(pos / predthreshold).astype(np.int64) - origin
+        pairs = [cellpairs(cell, shape, order, starts, counts, dx, dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1)]
+        a = np.concatenate([pair[0] for pair in pairs])
+        b = np.concatenate([pair[1] for pair in pairs])
+    else:
+        a = np.repeat(np.arange(len(pos)), len(pred))
+        b = np.tile(np.arange(len(pred)), len(pos))
+    predxdist = pred[b,0] - pos[a,0]
+    predydist = pred[b,1] - pos[a,1]
+    near = np.flatnonzero((abs(predxdist) < predthreshold) & (abs(predydist) < predthreshold))
+    preddist = np.sqrt(predxdist[near] ** 2 + predydist[near] ** 2)
+    inrange = (preddist < predthreshold) & (preddist > 0)
+    near = near[inrange]
+    return a[near], predxdist[near], predydist[near], preddist[inrange]
+
+# Flying away from predators
+def avoidance(pos):
+    force = np.zeros_like(pos)
+    if not predators:
+        return force
+    a, predxdist, predydist, preddist = predatorpairs(pos)
+    magnitude = -100000 / preddist
+    force[:,0] = np.bincount(a, magnitude * predxdist / preddist, len(pos))
+    force[:,1] = np.bincount(a, magnitude * predydist / preddist, len(pos))
+    return force
+
+# Autonomous predators fly in straight lines and bounce off the walls
+def movepredators(maxx, maxy):
+    for p in predators:
+        if p.autonomous:
+            p.x += p.vx
+            p.y += p.vy
+            if not 0 < p.x < maxx:
+                p.vx = -p.vx
+                p.x = min(max(p.x, 0), maxx)
+            if not 0 < p.y < maxy:
+                p.vy = -p.vy
+                p.y = min(max(p.y, 0), maxy)
+
+# Bird to bird component with the calculation chosen by forcemode
+def spacingforce(pos, query=None):
+    if forcemode == 'grid':
+        return gridspacing(pos, query)
+    elif forcemode == 'barneshut':
+        return barneshut(pos, query)
+    return spacing(pos, query)
+
+# Bird to bird component where settled birds only recalculate it every lodrate steps
+# The component is the offset part (the sum of offsets to the other birds) minus width times the sum of unit vectors,
+# and only the sum of unit vectors is held between updates. The offset part follows the motion of the flock:
+# in the exact and Barnes-Hut modes it is recalculated exactly from the flock total, and in grid mode the held
+# offset part is moved by how far the bird moved relative to the center of the birds around it
+# A bird is settled when its held sum of unit vectors was within lodtolerance per bird in the sum of the recalculated one,
+# and birds near walls or predators are always recalculated
+def multirateforce(maxx, maxy):
+    global heldunits
+    global heldoffsets
+    global heldcounts
+    global heldcenters
+    global heldpositions
+    global settled
+    n = len(positions)
+    grid = forcemode == 'grid'
+    fresh = heldunits is None or len(heldunits) != n
+    if fresh:
+        heldunits = np.zeros((n,2))
+        heldoffsets = np.zeros((n,2))
+        heldcounts = np.zeros(n)
+        heldcenters = positions.copy()
+        heldpositions = positions.copy()
+        settled = np.zeros(n, dtype=bool)
+    if grid:
+        centers = neighborhoodcenters(positions)
+        offsets = heldoffsets + heldcounts[:,None] * ((centers - heldcenters) - (positions - heldpositions))
+    else:
+        offsets = positions.sum(axis=0) - n * positions
+    force = offsets - width * heldunits
+    active = ~settled | (np.arange(n) % lodrate == steps % lodrate)
+    active |= ((positions < lodmargin) | (positions > [maxx - lodmargin, maxy - lodmargin])).any(axis=1)
     if predators:
-        predxdist = predators.x - canvas.coords(a)[0]
-        predydist = predators.y - canvas.coords(a)[1]
-        if abs(predxdist) < predthreshold or abs(predydist) < predthreshold:
-            preddist = sqrt(predxdist ** 2 + predydist ** 2)
-            if preddist < predthreshold:
-                magnitude = -100000 / preddist
-                vectors.append([magnitude *predxdist / preddist, magnitude * predydist / preddist])
+        active[predatorpairs(positions)[0]] = True
+    query = np.flatnonzero(active)
+    if grid:
+        new, units, counts = gridspacing(positions, query, parts=True)
+        heldoffsets[query] = new + width * units
+        heldcounts[query] = counts
+        heldcenters[query] = centers[query]
+    else:
+        new = spacingforce(positions, query)
+        units = (offsets[query] - new) / width
+        counts = n - 1
+    error = np.sqrt(((units - heldunits[query]) ** 2).sum(axis=1))
+    settled[query] = (error <= lodtolerance * np.maximum(counts, 1)) & (not fresh)
+    force[query] = new
+    heldunits[query] = units
+    heldpositions[query] = positions[query]
+    return force
+
+# Calculates the next position and direction of birds from their spacing force
+def fly(pos, dirs, force, maxx, maxy):
+    start = time.perf_counter()
+    wall = walls(pos, maxx, maxy)
+    record('walls', start)
+    start = time.perf_counter()
+    avoid = avoidance(pos)
+    record('predators', start)
+    start = time.perf_counter()
     # Final vector is a combination of all components
-    final = [0, 0]
-    for vector in vectors:
-        final[0]+= vector[0]
-        final[1] += vector[1]
-    final[0]=dirchange * directions[ovalindex][0] + (1-dirchange)*final[0]
-    final[1] = dirchange * directions[ovalindex][1] + (1 - dirchange) * final[1]
+    final = force + wall + avoid
+    final *= 1 - dirchange
+    final += dirchange * dirs
     # Enforce minimum and maximum flight distance
-    length = sqrt(final[0]**2+final[1]**2)
-    if length > lenthreshold:
-        final[0] *= lenthreshold / length
-        final[1] *= lenthreshold / length
-    if length < flightthreshold:
-        final[0] *= flightthreshold / length
-        final[1] *= flightthreshold / length
-    directions[ovalindex]=final
-    return final
+    length = np.sqrt((final ** 2).sum(axis=1))
+    limit = np.clip(length, flightthreshold, lenthreshold)
+    final *= np.divide(limit, length, out=np.ones_like(length), where=length>0)[:,None]
+    newdirs = final.copy()
+    # Random component of bird movement
+    final += (generators['flight'].random(final.shape) - 0.5) * 2 * randstep
+    # Enforce canvas boundaries
+    moved = pos + final
+    inside = ((moved > 0) & (moved < [maxx, maxy])).all(axis=1)
+    moved = np.where(inside[:,None], moved, pos - final)
+    record('flight', start)
+    return moved, newdirs
+
+# Calculates the next position and direction of every bird at once
+# The current buffers are only read, so every bird responds to the same snapshot of the flock
+def step(maxx, maxy):
+    global positions
+    global directions
+    global nextpositions
+    global nextdirections
+    global steps
+    begin = time.perf_counter()
+    movepredators(maxx, maxy)
+    start = time.perf_counter()
+    if multirate:
+        force = multirateforce(maxx, maxy)
+    else:
+        force = spacingforce(positions)
+    record('spacing', start)
+    newpos, newdirs = fly(positions, directions, force, maxx, maxy)
+    np.copyto(nextpositions, newpos)
+    np.copyto(nextdirections, newdirs)
+    positions, nextpositions = nextpositions, positions
+    directions, nextdirections = nextdirections, directions
+    steps += 1
+    record('step', begin)
+
+# Adds the time since start to the rolling samples of a phase
+def record(phase, start):
+    if profiling:
+        if phase not in profile:
+            profile[phase] = collections.deque(maxlen=profilelength)
+        profile[phase].append(time.perf_counter() - start)
+
+# Rolling statistics of every phase in milliseconds, and the frame and step rates
+def profilestats():
+    stats = {}
+    for phase, samples in list(profile.items()):
+        samples = np.array(samples) * 1000
+        if len(samples):
+            stats[phase] = {'mean': samples.mean(), 'median': np.median(samples), 'max': samples.max(),
+                            'last': samples[-1], 'count': len(samples)}
+    if 'frame' in stats:
+        stats['frame']['fps'] = 1000 / stats['frame']['mean']
+    if 'step' in stats:
+        stats['step']['rate'] = 1000 / stats['step']['mean']
+    return stats
+
+# Writes the profile statistics to a csv file, or to a json file together with the raw samples
+def exportprofile(filename):
+    stats = profilestats()
+    if filename.endswith('.csv'):
+        with open(filename, 'w', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(['phase', 'mean_ms', 'median_ms', 'max_ms', 'last_ms', 'count'])
+            for phase, stat in stats.items():
+                writer.writerow([phase, stat['mean'], stat['median'], stat['max'], stat['last'], stat['count']])
+    else:
+        with open(filename, 'w') as file:
+            json.dump({'stats': stats, 'samples': {phase: list(samples) for phase, samples in profile.items()}}, file,
+                      indent=1, default=float)
+
+# Shows or hides the profile overlay, which also turns profiling on
+def toggleoverlay(event=None):
+    global overlay
+    global profiling
+    global overlaytext
+    overlay = not overlay
+    if overlay:
+        profiling = True
+    elif overlaytext is not None:
+        canvas.delete(overlaytext)
+        overlaytext = None
+
+# Writes the rolling statistics in the corner of the canvas
+def showprofile():
+    global overlaytext
+    stats = profilestats()
+    lines = ['%s %.2f ms (max %.2f)' % (phase, stat['mean'], stat['max']) for phase, stat in stats.items()]
+    if 'frame' in stats:
+        lines.insert(0, '%.1f fps, %d birds' % (stats['frame']['fps'], len(positions)))
+    if overlaytext is None:
+        overlaytext = canvas.create_text(10, 10, anchor=NW, font=('Courier', 10), fill='#ff0000')
+    canvas.itemconfigure(overlaytext, text='\n'.join(lines))
+    canvas.tag_raise(overlaytext)
+
+# Module settings copied into worker processes
+settingnames = ['randstep', 'dirchange', 'predators', 'predthreshold', 'predindex', 'lenthreshold', 'flightthreshold',
+                'width', 'cutoff', 'boxwidth', 'boxheight']
+
+def settings():
+    return {name: globals()[name] for name in settingnames}
+
+# Worker process that owns the birds in one vertical strip of the box
+# Each tick it reads its strip and the halo of birds within the cutoff radius around it from the current shared buffers,
+# writes the next state of its own birds into the other buffers, and waits for the other strips before they are swapped
+def stripworker(name, n, strip, strips, ticks, barrier, setting, filename, workerseed, offset=0, flush=1000):
+    globals().update(setting)
+    generators['flight'] = np.random.default_rng(workerseed) # Each strip has its own flight stream
+    memory = shared_memory.SharedMemory(name=name)
+    buffers = np.ndarray((2, 2, n, 2), buffer=memory.buf)
+    pos = dirs = x = None
+    if filename:
+        trajectory = np.load(filename + '_positions.npy', mmap_mode='r+')
+        headings = np.load(filename + '_directions.npy', mmap_mode='r+')
+    radius = cutoff if cutoff else 2 * width
+    left = strip * boxwidth / strips
+    right = (strip + 1) * boxwidth / strips
+    try:
+        for tick in range(ticks):
+            movepredators(boxwidth, boxheight) # Every worker moves its own copy of the predators the same way
+            pos, dirs = buffers[tick % 2]
+            x = pos[:,0]
+            own = np.ones(n, dtype=bool)
+            if strip > 0:
+                own &= x >= left
+            if strip < strips - 1:
+                own &= x < right
+            halo = np.flatnonzero(own | ((x >= left - radius) & (x < right + radius)))
+            own = np.flatnonzero(own)
+            # Strips have fixed widths, so a strip without birds only keeps in step with the others
+            if len(own) > 0:
+                force = gridspacing(pos[halo], np.searchsorted(halo, own))
+                newpos, newdirs = fly(pos[own], dirs[own], force, boxwidth, boxheight)
+                buffers[(tick + 1) % 2, 0, own] = newpos
+                buffers[(tick + 1) % 2, 1, own] = newdirs
+                if filename:
+                    trajectory[offset + tick, own] = newpos
+                    headings[offset + tick, own] = newdirs
+            if filename and (tick + 1) % flush == 0:
+                trajectory.flush()
+                headings.flush()
+            barrier.wait()
+        if filename:
+            trajectory.flush()
+            headings.flush()
+    except BaseException:
+        barrier.abort() # The other strips stop waiting for this one instead of hanging
+        raise
+    finally:
+        pos = dirs = x = buffers = None # Views of the shared memory have to be released before it is closed
+        memory.close()
+
+# Steps the flock in lockstep worker processes that each own one vertical strip of the box
+# Birds only interact within the cutoff radius, since each strip only sees its halo of neighbors
+# The ticks are written to the trajectory files starting at row offset
+def parallel(ticks, workers, filename=None, offset=0, flush=1000):
+    global steps
+    n = len(positions)
+    memory = shared_memory.SharedMemory(create=True, size=max(2 * 2 * n * 2 * 8, 1))
+    buffers = np.ndarray((2, 2, n, 2), buffer=memory.buf)
+    try:
+        buffers[0, 0] = positions
+        buffers[0, 1] = directions
+        barrier = multiprocessing.Barrier(workers)
+        workerseeds = generators['flight'].integers(2 ** 63, size=workers)
+        processes = [multiprocessing.Process(target=stripworker, args=(memory.name, n, strip, workers, ticks, barrier, settings(), filename,
+                                                                       workerseeds[strip], offset, flush))
+                     for strip in range(workers)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        if any(process.exitcode != 0 for process in processes):
+            raise RuntimeError('A strip worker failed, the flock was left at its state before the parallel run')
+        positions[:] = buffers[ticks % 2, 0]
+        directions[:] = buffers[ticks % 2, 1]
+    finally:
+        buffers = None
+        memory.close()
+        memory.unlink()
+    for tick in range(ticks): # Predators are moved the same way the workers moved their copies
+        movepredators(boxwidth, boxheight)
+    steps += ticks
+
+# Removes all birds
+def clear():
+    global ovals
+    global positions
+    global directions
+    global nextpositions
+    global nextdirections
+    global heldunits
+    if canvas is not None:
+        for a in ovals:
+            canvas.delete(a)
+    ovals = []
+    positions = np.zeros((0,2))
+    directions = np.zeros((0,2))
+    nextpositions = np.zeros((0,2))
+    nextdirections = np.zeros((0,2))
+    heldunits = None
+
+# Steps the flock without a window, starting a new flock in the middle of the box if a flock size is given
+# Positions and directions of every tick are streamed to filename_positions.npy and filename_directions.npy,
+# which can be opened afterwards without loading them into memory using np.load(..., mmap_mode='r')
+# With more than one worker the box is split into strips that are simulated in parallel processes
+# A checkpoint is also written to filename_checkpoint.npz every checkpoints ticks
+def simulate(ticks, filename, birds=None, dtype=np.float32, flush=1000, workers=1, checkpoints=0):
+    if birds is not None:
+        clear()
+        generate(birds, boxwidth / 2, boxheight / 2)
+    shape = (ticks, len(positions), 2)
+    trajectory = np.lib.format.open_memmap(filename + '_positions.npy', mode='w+', dtype=dtype, shape=shape)
+    headings = np.lib.format.open_memmap(filename + '_directions.npy', mode='w+', dtype=dtype, shape=shape)
+    if workers > 1:
+        trajectory.flush()
+        headings.flush()
+        # With checkpoints the workers run one segment of ticks at a time, with a checkpoint after each segment
+        segment = checkpoints if checkpoints else max(ticks, 1)
+        for start in range(0, ticks, segment):
+            parallel(min(segment, ticks - start), workers, filename, start, flush)
+            if checkpoints and start + segment <= ticks:
+                checkpoint(filename + '_checkpoint.npz')
+        return trajectory, headings
+    for tick in range(ticks):
+        step(boxwidth, boxheight)
+        trajectory[tick] = positions
+        headings[tick] = directions
+        if (tick + 1) % flush == 0: # Written pages are handed back to the operating system periodically
+            trajectory.flush()
+            headings.flush()
+        if checkpoints and (tick + 1) % checkpoints == 0:
+            checkpoint(filename + '_checkpoint.npz')
+    trajectory.flush()
+    headings.flush()
+    return trajectory, headings
+
+# Settings that change the outcome of a run, which are stored with checkpoints
+checkpointnames = settingnames[:settingnames.index('predators')] + settingnames[settingnames.index('predators') + 1:] + \
+                  ['forcemode', 'theta', 'leafsize', 'chunk', 'spread', 'predspeed', 'multirate', 'lodrate', 'lodtolerance', 'lodmargin']
+
+# Saves the complete state of the flock to a binary .npz file
+# Positions and directions are stored at full precision together with the settings and the state of every random stream,
+# so a restored run continues exactly as the original would have
+def checkpoint(filename):
+    held = {}
+    if heldunits is not None:
+        held = {name: globals()[name] for name in heldnames}
+    np.savez(filename, positions=positions, directions=directions, steps=steps, **held,
+             predators=np.array([[p.x, p.y, p.vx, p.vy, p.autonomous] for p in predators], dtype=float).reshape(-1, 5),
+             generators=json.dumps({name: generator.bit_generator.state for name, generator in generators.items()}),
+             settings=json.dumps({name: globals()[name] for name in checkpointnames}), seed=json.dumps(seed))
+
+# Restores a checkpoint to resume or replay a run
+# Giving a new seed forks the run instead: the flock starts from the checkpoint but the random streams are new
+def restore(filename, newseed=None):
+    global positions
+    global directions
+    global nextpositions
+    global nextdirections
+    global predators
+    global steps
+    clear()
+    with np.load(filename) as data:
+        globals().update(json.loads(str(data['settings'])))
+        positions = data['positions'].copy()
+        directions = data['directions'].copy()
+        steps = int(data['steps'])
+        for name in heldnames:
+            if name in data:
+                globals()[name] = data[name].copy()
+        predators = []
+        for x, y, vx, vy, autonomous in data['predators']:
+            p = predator(x, y)
+            p.vx, p.vy, p.autonomous = vx, vy, bool(autonomous)
+            predators.append(p)
+        if newseed is None:
+            reseed(json.loads(str(data['seed'])))
+            for name, state in json.loads(str(data['generators'])).items():
+                generators[name].bit_generator.state = state
+        else:
+            reseed(newseed)
+    nextpositions = np.empty_like(positions)
+    nextdirections = np.empty_like(directions)
+    if canvas is not None:
+        draw()
+
+# Restores a checkpoint and simulates the following ticks again, streaming them to filename as in simulate()
+def replay(checkpointname, ticks, filename):
+    restore(checkpointname)
+    return simulate(ticks, filename)
+
+# Draws every bird as a disc into an image the size of the box
+def rasterize(pos=None, background=(255,255,255), color=(0,0,0)):
+    global frame
+    if pos is None:
+        pos = positions
+    if frame is None or frame.shape[:2] != (boxheight, boxwidth):
+        frame = np.empty((boxheight, boxwidth, 3), dtype=np.uint8)
+    frame[:] = background
+    offsety, offsetx = np.mgrid[-r:r+1, -r:r+1]
+    disc = offsetx ** 2 + offsety ** 2 <= r ** 2
+    x = np.rint(pos[:,0]).astype(np.int64)[:,None] + offsetx[disc]
+    y = np.rint(pos[:,1]).astype(np.int64)[:,None] + offsety[disc]
+    inside = (x >= 0) & (x < boxwidth) & (y >= 0) & (y < boxheight)
+    frame[y[inside], x[inside]] = color
+    return frame
+
+# Draws the flock either with one oval per bird or with a single image pushed to the canvas
+def draw(pos=None):
+    global ovals
+    global photo
+    global image
+    if pos is None:
+        pos = positions
+    if renderer == 'raster' or (renderer == 'auto' and len(pos) > rasterthreshold):
+        for a in ovals:
+            canvas.delete(a)
+        ovals = []
+        background = tuple(c // 256 for c in canvas.winfo_rgb(canvas['background']))
+        rasterize(pos, background)
+        if photo is None or photo.width() != boxwidth or photo.height() != boxheight:
+            photo = PhotoImage(width=boxwidth, height=boxheight)
+            if image is not None:
+                canvas.delete(image)
+            image = canvas.create_image(0, 0, image=photo, anchor=NW)
+        photo.configure(data=b'P6 %d %d 255 ' % (boxwidth, boxheight) + frame.tobytes(), format='PPM')
+    else:
+        if image is not None:
+            canvas.delete(image)
+            image = None
+            photo = None
+        while len(ovals) < len(pos):
+            ovals.append(canvas.create_oval(0, 0, 0, 0, fill='#000000'))
+        for a, (x, y) in zip(ovals, pos.tolist()):
+            canvas.coords(a, x-r, y-r, x+r, y+r)
+
+# Mean distance from each bird to its nearest neighbor
+def nearestdistance(pos):
+    nearest = np.empty(len(pos))
+    for i in range(0, len(pos), chunk):
+        dist = (pos[:,0] - pos[i:i+chunk,0,None]) ** 2 + (pos[:,1] - pos[i:i+chunk,1,None]) ** 2
+        dist[np.arange(len(dist)), np.arange(i, i + len(dist))] = np.inf
+        nearest[i:i+chunk] = np.sqrt(dist.min(axis=1))
+    return nearest.mean()
+
+# Length of the mean unit direction (1 when all birds fly the same way, near 0 when directions are random)
+def polarization(dirs):
+    length = np.sqrt((dirs ** 2).sum(axis=1))
+    units = dirs[length > 0] / length[length > 0,None]
+    return np.sqrt((units.mean(axis=0) ** 2).sum()) if len(units) else 0.0
+
+# Runs one headless configuration of the sweep and measures the flock
+# After the warm up, a predator appears at the center of the flock and the escape time is the number of ticks
+# until no bird is within the escape distance (the optimal distance by default) of it, or nan if the flock does not escape in time
+def trial(setting):
+    global predators
+    global steps
+    setting = dict(setting)
+    seed = setting.pop('seed')
+    birds = setting.pop('birds')
+    ticks = setting.pop('ticks')
+    escapeticks = setting.pop('escapeticks')
+    escapedistance = setting.pop('escapedistance')
+    globals().update(setting)
+    if not escapedistance:
+        escapedistance = width
+    reseed(seed)
+    predators = []
+    steps = 0 # Pool workers run many trials, so nothing may carry over from the previous one
+    profile.clear()
+    clear()
+    generate(birds, boxwidth / 2, boxheight / 2)
+    for tick in range(ticks):
+        step(boxwidth, boxheight)
+    result = dict(setting, seed=seed, nearest=nearestdistance(positions), polarization=polarization(directions))
+    center = positions.mean(axis=0)
+    predators = [predator(center[0], center[1])]
+    escape = np.nan
+    for tick in range(escapeticks):
+        step(boxwidth, boxheight)
+        if (((positions - center) ** 2).sum(axis=1) > escapedistance ** 2).all():
+            escape = tick + 1
+            break
+    result['escape'] = escape
+    return result
+
+# Runs headless simulations for every combination of the module parameters in grid (name: list of values)
+# in a process pool and collects one row of metrics per configuration, optionally written to a csv file
+# Every configuration is run with the same repeats seeds (seed, seed+1, ...), so configurations differ only in their parameters
+def sweep(grid, filename=None, processes=None, birds=500, ticks=200, escapeticks=200, escapedistance=None, seed=0, repeats=1):
+    for name in grid:
+        if name not in globals():
+            raise ValueError('Unknown parameter ' + name)
+    names = list(grid)
+    configurations = [dict(zip(names, values), seed=seed + i, birds=birds, ticks=ticks, escapeticks=escapeticks,
+                           escapedistance=escapedistance)
+                      for values in itertools.product(*[grid[name] for name in names]) for i in range(repeats)]
+    with multiprocessing.Pool(processes) as pool:
+        results = pool.map(trial, configurations)
+    if filename:
+        with open(filename, 'w', newline='') as file:
+            writer = csv.DictWriter(file, fieldnames=list(results[0]))
+            writer.writeheader()
+            writer.writerows(results)
+    return results
 
 # Move the flock
 def move():
-    maxx = canvas.winfo_width()
-    maxy = canvas.winfo_height()
-    for a in ovals:
-        vector = neighbors(a)
-        xrand = (random()-0.5)*2*randstep
-        yrand = (random() - 0.5) * 2 * randstep
-        x = xrand + vector[0]
-        y = yrand + vector[1]
-        # Enforce canvas boundaries
-        locx = canvas.coords(a)[0]
-        locy = canvas.coords(a)[1]
-        if 0<locx+x<maxx and 0<locy+y<maxy:
-            canvas.move(a,x,y)
-        else:
-            canvas.move(a, -x, -y)
+    global boxwidth
+    global boxheight
+    boxwidth = canvas.winfo_width()
+    boxheight = canvas.winfo_height()
+    step(boxwidth, boxheight)
+    draw()
+
+# Runs the physics at a fixed time step on the worker thread and publishes a copy of the positions after every step
+def physics():
+    global snapshot
+    due = time.perf_counter()
+    while animating:
+        step(boxwidth, boxheight)
+        with snapshotlock:
+            snapshot = positions.copy()
+        due += timestep
+        delay = due - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        else: # Physics is slower than real time, so the missed time is dropped
+            due = time.perf_counter()
+
+# Scheduler tick, called through window.after so the event loop keeps running between frames
+def tick():
+    global boxwidth
+    global boxheight
+    global lasttime
+    global lag
+    global snapshot
+    global job
+    if not animating:
+        return
+    boxwidth = canvas.winfo_width()
+    boxheight = canvas.winfo_height()
+    now = time.perf_counter()
+    record('frame', lasttime)
+    lag += now - lasttime
+    lasttime = now
+    start = time.perf_counter()
+    if threaded:
+        with snapshotlock:
+            pos = snapshot
+            snapshot = None
+        if pos is not None: # Only new snapshots are drawn
+            draw(pos)
+            record('render', start)
+        lag = 0 # The worker thread keeps its own time, so frames are simply drawn once per time step
+    else:
+        # Several physics steps are run when drawing falls behind, so the frames in between are skipped
+        substeps = 0
+        while lag >= timestep and substeps < maxsubsteps:
+            step(boxwidth, boxheight)
+            lag -= timestep
+            substeps += 1
+        lag = min(lag, timestep) # Lag the physics cannot catch up with is dropped instead of piling up
+        if substeps:
+            start = time.perf_counter()
+            draw()
+            record('render', start)
+    if overlay:
+        showprofile()
+    # Pending redraws are done now so their cost is measured
+    start = time.perf_counter()
+    window.update_idletasks()
+    record('update', start)
+    job = window.after(max(1, int((timestep - lag) * 1000)), tick)
 
 # Predator class
 class predator():
-    def __init__(self,x,y):
+    def __init__(self,x,y,autonomous=False):
         self.x = x
         self.y = y
+        self.autonomous = autonomous
+        self.vx = 0
+        self.vy = 0
+        if autonomous:
+            angle = generators['predators'].random() * 2 * pi
+            self.vx = predspeed * cos(angle)
+            self.vy = predspeed * sin(angle)
 
-# Create predator
+# Move the chasing predator
 def attack(event):
-    global predators
-    predators = predator(event.x, event.y)
+    chasers = [p for p in predators if not p.autonomous]
+    if chasers:
+        chasers[0].x = event.x
+        chasers[0].y = event.y
+    else:
+        predators.append(predator(event.x, event.y))
+
+# Release an autonomous predator
+def release(event):
+    predators.append(predator(event.x, event.y, autonomous=True))
 
 # Toggle animation
 def movetoggle(event):
     global animating
-    global predators
+    global lasttime
+    global lag
+    global worker
     if not animating:
+        if worker is not None: # A physics loop stopped just before has to finish its step first, so only one ever runs
+            worker.join()
+            worker = None
         animating = True
-        while animating:
-            move()
-            window.update()
-            time.sleep(0.001)
+        lasttime = time.perf_counter()
+        lag = 0
+        if threaded:
+            worker = threading.Thread(target=physics, daemon=True)
+            worker.start()
+        tick()
     else:
         animating = False
+        if job is not None:
+            window.after_cancel(job)
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2: # Headless simulation
+        simulate(int(sys.argv[1]), sys.argv[2], int(sys.argv[3]) if len(sys.argv) > 3 else size,
+                 workers=int(sys.argv[4]) if len(sys.argv) > 4 else 1)
+    else:
+        window = Tk(className = ' Flock')
+        canvas = Canvas(window, width=boxwidth, height=boxheight)
+        canvas.pack(fill=BOTH, expand=True )
 
-# Bind left and right mouse click
-window.bind('<Button-3>',movetoggle)
-window.bind('<Button-1>',attack)
+        # Bind left and right mouse click
+        window.bind('<Button-3>',movetoggle)
+        window.bind('<Button-1>',attack)
+        window.bind('<Shift-Button-1>',release)
+        window.bind('<Key-p>',toggleoverlay)
 
-# Generate flock
-generate(170,600,400)
-mainloop()
+        # Generate flock
+        generate(size,600,400)
+        mainloop()